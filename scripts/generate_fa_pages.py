@@ -6,42 +6,98 @@ setting the correct lang/dir attributes, and injecting RTL specific styles.
 
 from __future__ import annotations
 
+import argparse
+import atexit
+import codecs
+import hashlib
+import json
+import os
+import re
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict, List, Tuple
+from typing import Dict, FrozenSet, Iterable, List, Optional, Tuple
+from urllib.parse import quote_plus, urlencode
 
 import requests
-from bs4 import BeautifulSoup, Comment, Doctype, NavigableString
+from requests.adapters import HTTPAdapter
+from bs4 import BeautifulSoup, Comment, Doctype, NavigableString, Tag
+from bs4.element import PageElement
+
+try:
+    from orjson import loads as json_loads
+except ImportError:  # pragma: no cover
+    json_loads = json.loads
 
 ROOT = Path(__file__).resolve().parents[1]
 HTML_DIR = ROOT
+CACHE_FILE = ROOT / ".fa_cache.json"
+MANIFEST_FILE = ROOT / ".fa_manifest.json"
 ATTRS_TO_TRANSLATE = ("placeholder", "title", "alt", "aria-label", "value")
 EXCLUDED_TEXT_PARENTS = {"script", "style"}
 API_URL = "https://translate.googleapis.com/translate_a/single"
+DEFAULT_KEEP_TERMS = ("Archex", "Archex.", "DuruThemes")
+LINK_PATTERN = re.compile(
+    r"^(?:[a-z][a-z0-9+.-]*://\S+|www\.\S+|[^\s@]+@[^\s@]+\.[^\s@]+)$", re.IGNORECASE
+)
+BASE_PARAMS = (("client", "gtx"), ("sl", "auto"), ("tl", "fa"), ("dt", "t"))
 REQUEST_TIMEOUT = 15
-SLEEP_SECONDS = 0.15
+MAX_WORKERS = 8
+MAX_ATTEMPTS = 3
+MAX_RETRY_AFTER = 30.0
+MAX_URL_LENGTH = 1800
+QUERY_BUDGET = MAX_URL_LENGTH - len(f"{API_URL}?{urlencode(BASE_PARAMS)}")
 
 
+@lru_cache(maxsize=None)
 def split_text(text: str) -> Tuple[str, str, str]:
     stripped = text.strip()
     if not stripped:
         return "", "", ""
-    leading_len = len(text) - len(text.lstrip())
-    trailing_len = len(text) - len(text.rstrip())
-    leading = text[:leading_len]
-    trailing = text[len(text) - trailing_len :] if trailing_len else ""
-    return leading, stripped, trailing
+    start = len(text) - len(text.lstrip())
+    return text[:start], stripped, text[start + len(stripped) :]
+
+
+def query_length(text: str) -> int:
+    return len("&q=") + len(quote_plus(text))
+
+
+def is_translatable(text: str, keep_terms: FrozenSet[str] = frozenset()) -> bool:
+    if text in keep_terms or LINK_PATTERN.match(text):
+        return False
+    return any(ch.isalpha() for ch in text)
 
 
 def collect_entries(soup: BeautifulSoup) -> List[Dict]:
     entries: List[Dict] = []
-    for node in soup.find_all(string=True):
-        if isinstance(node, (Comment, Doctype)):
+    stack: List[PageElement] = [soup]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, Tag):
+            if node.name not in EXCLUDED_TEXT_PARENTS:
+                stack.extend(reversed(node.contents))
+            for attr in ATTRS_TO_TRANSLATE:
+                value = node.attrs.get(attr)
+                if not value or not isinstance(value, str):
+                    continue
+                leading, stripped, trailing = split_text(value)
+                if not stripped:
+                    continue
+                entries.append(
+                    {
+                        "type": "attr",
+                        "element": node,
+                        "attr": attr,
+                        "leading": leading,
+                        "content": stripped,
+                        "trailing": trailing,
+                    }
+                )
             continue
-        if node.parent and node.parent.name in EXCLUDED_TEXT_PARENTS:
+        if not isinstance(node, NavigableString) or isinstance(node, (Comment, Doctype)):
             continue
-        text = str(node)
-        leading, stripped, trailing = split_text(text)
+        leading, stripped, trailing = split_text(str(node))
         if not stripped:
             continue
         entries.append(
@@ -53,78 +109,162 @@ def collect_entries(soup: BeautifulSoup) -> List[Dict]:
                 "trailing": trailing,
             }
         )
-    for attr in ATTRS_TO_TRANSLATE:
-        for element in soup.find_all(attrs={attr: True}):
-            value = element.get(attr)
-            if not value or not value.strip():
-                continue
-            leading, stripped, trailing = split_text(value)
-            if not stripped:
-                continue
-            entries.append(
-                {
-                    "type": "attr",
-                    "element": element,
-                    "attr": attr,
-                    "leading": leading,
-                    "content": stripped,
-                    "trailing": trailing,
-                }
-            )
     return entries
 
 
 class GoogleTranslateClient:
-    def __init__(self) -> None:
+    HEADERS = {
+        "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "
+        "(KHTML, like Gecko) Chrome/129.0.0.0 Safari/537.36",
+    }
+
+    def __init__(
+        self,
+        cache_path: Optional[Path] = CACHE_FILE,
+        use_cache: bool = True,
+        keep_terms: Iterable[str] = DEFAULT_KEEP_TERMS,
+    ) -> None:
         self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS * 2)
+        self.session.mount("https://", adapter)
         self.cache: Dict[str, str] = {}
+        self.supports_batching = True
+        self.keep_terms = frozenset(keep_terms)
+        self.cache_path = cache_path
+        if cache_path is not None:
+            if use_cache and cache_path.exists():
+                self.cache.update(self._load(cache_path))
+            atexit.register(self._save)
 
-    def translate(self, text: str) -> str:
-        if text in self.cache:
-            return self.cache[text]
-        translated = self._translate_remote(text)
-        self.cache[text] = translated
-        return translated
-
-    def _translate_remote(self, text: str) -> str:
-        params = {
-            "client": "gtx",
-            "sl": "auto",
-            "tl": "fa",
-            "dt": "t",
-            "q": text,
-        }
-        headers = {
-            "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "
-            "(KHTML, like Gecko) Chrome/129.0.0.0 Safari/537.36",
+    @staticmethod
+    def _load(cache_path: Path) -> Dict[str, str]:
+        try:
+            cache = json.loads(cache_path.read_text(encoding="utf-8"))
+        except ValueError:
+            return {}
+        if not isinstance(cache, dict):
+            return {}
+        return {
+            key: value
+            for key, value in cache.items()
+            if isinstance(key, str) and isinstance(value, str)
         }
+
+    def _save(self) -> None:
+        if self.cache_path is None:
+            return
+        write_atomic(self.cache_path, json.dumps(self.cache, ensure_ascii=False))
+
+    def translate(self, text: str) -> str:
+        return self.translate_batch([text])[0]
+
+    def translate_batch(self, texts: List[str]) -> List[str]:
+        resolved: Dict[str, Optional[str]] = {}
+        pending = []
+        for text in texts:
+            if text in resolved:
+                continue
+            if not is_translatable(text, self.keep_terms):
+                resolved[text] = text
+                continue
+            translated = self.cache.get(text)
+            resolved[text] = translated
+            if translated is None:
+                pending.append(text)
+        if pending:
+            batches = self._chunk(pending)
+            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+                for batch, translations in zip(
+                    batches, executor.map(self._translate_remote, batches)
+                ):
+                    fetched = dict(zip(batch, translations))
+                    self.cache.update(fetched)
+                    resolved.update(fetched)
+        return [resolved[text] for text in texts]
+
+    @staticmethod
+    def _chunk(texts: List[str]) -> List[List[str]]:
+        batches: List[List[str]] = []
+        batch: List[str] = []
+        size = 0
+        for text in texts:
+            text_size = query_length(text)
+            if batch and size + text_size > QUERY_BUDGET:
+                batches.append(batch)
+                batch, size = [], 0
+            batch.append(text)
+            size += text_size
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _translate_remote(self, batch: List[str]) -> List[str]:
+        if len(batch) > 1:
+            if self.supports_batching:
+                translations = self._parse_results(self._request(batch), len(batch))
+                if translations is not None:
+                    return translations
+                self.supports_batching = False
+            return [self._translate_remote([text])[0] for text in batch]
+        translations = self._parse_results([self._request(batch)], 1)
+        if translations is None:
+            raise RuntimeError(f"Unexpected translation response for {batch[0]!r}")
+        return translations
+
+    @staticmethod
+    def _parse_results(results: object, expected: int) -> Optional[List[str]]:
+        if not isinstance(results, list) or len(results) != expected:
+            return None
+        translations = []
+        for result in results:
+            if not isinstance(result, list) or not result:
+                return None
+            segments = result[0]
+            if not isinstance(segments, list) or not all(
+                isinstance(segment, list) and segment for segment in segments
+            ):
+                return None
+            translations.append("".join(segment[0] for segment in segments if segment[0]))
+        return translations
+
+    def _request(self, batch: List[str]) -> object:
+        queries = [("q", text) for text in batch]
+        use_post = sum(query_length(text) for text in batch) > QUERY_BUDGET
         last_error = None
-        for attempt in range(3):
+        for attempt in range(MAX_ATTEMPTS):
             try:
-                response = self.session.get(
-                    API_URL, params=params, headers=headers, timeout=REQUEST_TIMEOUT
-                )
+                if use_post:
+                    response = self.session.post(
+                        API_URL,
+                        params=BASE_PARAMS,
+                        data=queries,
+                        headers=self.HEADERS,
+                        timeout=REQUEST_TIMEOUT,
+                    )
+                else:
+                    response = self.session.get(
+                        API_URL,
+                        params=list(BASE_PARAMS) + queries,
+                        headers=self.HEADERS,
+                        timeout=REQUEST_TIMEOUT,
+                    )
                 response.raise_for_status()
-                data = response.json()
-                translated_segments = [segment[0] for segment in data[0] if segment[0]]
-                translation = "".join(translated_segments)
-                time.sleep(SLEEP_SECONDS)
-                return translation
-            except requests.RequestException as exc:  # pragma: no cover
+                return json_loads(response.content)
+            except (requests.RequestException, ValueError) as exc:  # pragma: no cover
                 last_error = exc
-                time.sleep(1 + attempt)
+                if attempt + 1 < MAX_ATTEMPTS:
+                    time.sleep(self._backoff(exc, attempt))
         raise RuntimeError(f"Translation failed after retries: {last_error}")
 
-
-def translate_texts(entries: List[Dict], translator: GoogleTranslateClient) -> None:
-    unique_strings: Dict[str, str] = {}
-    for entry in entries:
-        if entry["content"] not in unique_strings:
-            unique_strings[entry["content"]] = ""
-    for text in unique_strings:
-        unique_strings[text] = translator.translate(text)
-    for entry in entries:
-        apply_translation(entry, unique_strings[entry["content"]])
+    @staticmethod
+    def _backoff(exc: Exception, attempt: int) -> float:
+        response = getattr(exc, "response", None)
+        if response is not None and response.status_code == 429:
+            retry_after = response.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                return min(float(retry_after), MAX_RETRY_AFTER)
+            return 2.0 * (1 + attempt)
+        return 1.0 + attempt
 
 
 def apply_translation(entry: Dict, translated_text: str) -> None:
@@ -170,10 +310,7 @@ def ensure_rtl_script(soup: BeautifulSoup) -> None:
     body = soup.find("body")
     if not body:
         return
-    has_script = any(
-        tag.get("src") == "js/rtl.js" for tag in body.find_all("script", attrs={"src": True})
-    )
-    if has_script:
+    if body.find("script", attrs={"src": "js/rtl.js"}) is not None:
         return
     main_script = body.find("script", attrs={"src": "js/main.js"})
     rtl_tag = soup.new_tag("script", src="js/rtl.js")
@@ -183,23 +320,213 @@ def ensure_rtl_script(soup: BeautifulSoup) -> None:
         body.append(rtl_tag)
 
 
+def fa_path_for(html_file: Path) -> Path:
+    return html_file.with_name(f"{html_file.stem}-fa{html_file.suffix}")
+
+
+def digest(data: bytes) -> str:
+    return hashlib.sha1(data).hexdigest()
+
+
+def translations_digest(translations: Dict[str, str]) -> str:
+    return digest(json.dumps(translations, ensure_ascii=False, sort_keys=True).encode())
+
+
+def write_atomic(path: Path, text: str) -> None:
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    tmp_path.write_text(text, encoding="utf-8")
+    os.replace(tmp_path, path)
+
+
+def load_manifest() -> Dict[str, Dict]:
+    if not MANIFEST_FILE.exists():
+        return {}
+    try:
+        manifest = json.loads(MANIFEST_FILE.read_text(encoding="utf-8"))
+    except ValueError:
+        return {}
+    return manifest if isinstance(manifest, dict) else {}
+
+
+def save_manifest(manifest: Dict[str, Dict]) -> None:
+    write_atomic(
+        MANIFEST_FILE,
+        json.dumps(manifest, ensure_ascii=False, indent=2, sort_keys=True),
+    )
+
+
+def load_page(raw: bytes) -> BeautifulSoup:
+    if raw.startswith(codecs.BOM_UTF8):
+        raw = raw[len(codecs.BOM_UTF8) :]
+    return BeautifulSoup(raw, "lxml", from_encoding="utf-8")
+
+
+def group_entries(entries: List[Dict]) -> Dict[str, List[Dict]]:
+    buckets: Dict[str, List[Dict]] = {}
+    for entry in entries:
+        buckets.setdefault(entry["content"], []).append(entry)
+    return buckets
+
+
+def prepare_page(raw: bytes) -> Tuple[BeautifulSoup, Dict[str, List[Dict]]]:
+    soup = load_page(raw)
+    ensure_rtl_attributes(soup)
+    ensure_rtl_stylesheet(soup)
+    ensure_rtl_script(soup)
+    return soup, group_entries(collect_entries(soup))
+
+
+def render_page(
+    html_file: Path,
+    soup: BeautifulSoup,
+    buckets: Dict[str, List[Dict]],
+    translations: Dict[str, str],
+) -> Tuple[Path, int]:
+    count = 0
+    for content, group in buckets.items():
+        translated = translations[content]
+        for entry in group:
+            apply_translation(entry, translated)
+        count += len(group)
+    fa_file = fa_path_for(html_file)
+    fa_file.write_text(str(soup), encoding="utf-8")
+    return fa_file, count
+
+
+def collect_strings(raw: bytes) -> List[str]:
+    return list(prepare_page(raw)[1])
+
+
+def process_file(
+    html_file: Path, raw: bytes, translations: Dict[str, str]
+) -> Tuple[Path, int]:
+    soup, buckets = prepare_page(raw)
+    return render_page(html_file, soup, buckets, translations)
+
+
+def translate_pages(
+    page_strings: List[List[str]], translator: GoogleTranslateClient
+) -> List[Dict[str, str]]:
+    all_strings = list(dict.fromkeys(s for strings in page_strings for s in strings))
+    translations = dict(zip(all_strings, translator.translate_batch(all_strings)))
+    return [{text: translations[text] for text in strings} for strings in page_strings]
+
+
+def generate_in_process(
+    sources: Dict[Path, bytes], translator: GoogleTranslateClient
+) -> Tuple[List[Tuple[Path, int]], List[Dict[str, str]]]:
+    pages = [prepare_page(raw) for raw in sources.values()]
+    page_translations = translate_pages(
+        [list(buckets) for _, buckets in pages], translator
+    )
+    results = [
+        render_page(html_file, soup, buckets, translations)
+        for html_file, (soup, buckets), translations in zip(
+            sources, pages, page_translations
+        )
+    ]
+    return results, page_translations
+
+
+def generate_in_pool(
+    sources: Dict[Path, bytes], translator: GoogleTranslateClient
+) -> Tuple[List[Tuple[Path, int]], List[Dict[str, str]]]:
+    with ProcessPoolExecutor() as executor:
+        page_strings = list(executor.map(collect_strings, sources.values()))
+        page_translations = translate_pages(page_strings, translator)
+        results = list(
+            executor.map(process_file, sources, sources.values(), page_translations)
+        )
+    return results, page_translations
+
+
+def find_stale_pages(
+    sources: Dict[Path, bytes],
+    manifest: Dict[str, Dict],
+    generator_hash: str,
+    translator: GoogleTranslateClient,
+) -> Dict[Path, bytes]:
+    stale: Dict[Path, bytes] = {}
+    unchanged: List[Path] = []
+    for html_file, raw in sources.items():
+        record = manifest.get(html_file.name)
+        if (
+            isinstance(record, dict)
+            and record.get("source") == digest(raw)
+            and record.get("generator") == generator_hash
+            and isinstance(record.get("strings"), list)
+            and all(isinstance(text, str) for text in record["strings"])
+            and isinstance(record.get("translations"), str)
+            and fa_path_for(html_file).exists()
+        ):
+            unchanged.append(html_file)
+        else:
+            stale[html_file] = raw
+    page_translations = translate_pages(
+        [manifest[html_file.name]["strings"] for html_file in unchanged], translator
+    )
+    for html_file, translations in zip(unchanged, page_translations):
+        if translations_digest(translations) != manifest[html_file.name]["translations"]:
+            stale[html_file] = sources[html_file]
+    return {html_file: stale[html_file] for html_file in sources if html_file in stale}
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help=(
+            f"ignore {CACHE_FILE.name} and {MANIFEST_FILE.name}, re-translating "
+            "every string and regenerating every page"
+        ),
+    )
+    parser.add_argument(
+        "--keep",
+        action="append",
+        default=[],
+        metavar="TERM",
+        help=(
+            "leave TERM untranslated when it is an entire text node or attribute "
+            "value; may be repeated (always kept: "
+            f"{', '.join(DEFAULT_KEEP_TERMS)})"
+        ),
+    )
+    return parser.parse_args()
+
+
 def main() -> None:
-    translator = GoogleTranslateClient()
+    args = parse_args()
+    translator = GoogleTranslateClient(
+        use_cache=not args.no_cache, keep_terms=DEFAULT_KEEP_TERMS + tuple(args.keep)
+    )
     html_files = sorted(
         path
         for path in HTML_DIR.glob("*.html")
         if not path.stem.endswith("-fa") and path.is_file()
     )
-    for html_file in html_files:
-        soup = BeautifulSoup(html_file.read_text(encoding="utf-8-sig"), "html.parser")
-        ensure_rtl_attributes(soup)
-        ensure_rtl_stylesheet(soup)
-        ensure_rtl_script(soup)
-        entries = collect_entries(soup)
-        translate_texts(entries, translator)
-        fa_file = html_file.with_name(f"{html_file.stem}-fa{html_file.suffix}")
-        fa_file.write_text(soup.prettify(), encoding="utf-8")
-        print(f"Created {fa_file.name} ({len(entries)} translated entries)")
+    manifest = load_manifest() if not args.no_cache else {}
+    generator_hash = digest(Path(__file__).read_bytes())
+    sources = {path: path.read_bytes() for path in html_files}
+    sources = find_stale_pages(sources, manifest, generator_hash, translator)
+    if not sources:
+        print("All Persian pages are up to date")
+        return
+    if (os.cpu_count() or 1) > 1 and len(sources) > 1:
+        results, page_translations = generate_in_pool(sources, translator)
+    else:
+        results, page_translations = generate_in_process(sources, translator)
+    for (html_file, raw), (fa_file, count), translations in zip(
+        sources.items(), results, page_translations
+    ):
+        manifest[html_file.name] = {
+            "source": digest(raw),
+            "generator": generator_hash,
+            "strings": list(translations),
+            "translations": translations_digest(translations),
+        }
+        print(f"Created {fa_file.name} ({count} translated entries)")
+    save_manifest(manifest)
 
 
 if __name__ == "__main__":
@@ -36,9 +36,10 @@ def update_file(path: Path) -> None:
     for line in lines:
         if "css/plugins.css" in line:
             continue
-        match = SCRIPT_SRC_PATTERN.search(line)
-        if match and match.group(1) in OLD_JS_FILES:
-            continue
+        if "<script" in line:
+            match = SCRIPT_SRC_PATTERN.search(line)
+            if match and match.group(1) in OLD_JS_FILES:
+                continue
         if "</body>" in line and not inserted_script:
             new_lines.append(MAIN_SCRIPT_TAG + newline)
             inserted_script = True